@@ -1,9 +1,11 @@
 import sys
-import io
 import os
+import builtins
+import re
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
 from pyspark.sql import SparkSession
+from pyspark.storagelevel import StorageLevel
 from urllib.parse import quote_plus
 from urllib.parse import unquote_plus
 
@@ -14,10 +16,15 @@ _ORIG_ANNOT_ID = 'origAnnotID'
 _PARENT_ID = 'parentId'
 _ATTR = 'attr'
 _OM_NON_ATTRIBUTE_PROPERTIES = [_ORIG, _ORIG_ANNOT_ID, _PARENT_ID]
+_OM_NON_ATTRIBUTE_PROPERTIES_SET = frozenset(_OM_NON_ATTRIBUTE_PROPERTIES)
 _OM_ANNOT_SET = 'om'
 _WILDCARD = '*'
+# Name-value pair (name=value) in the ampersand delimited other column
+_NAME_VALUE_PAIR = re.compile(r'(?:^|&)(([^&=]*)=([^&=]*))(?=&|$)')
+# Characters that are changed by quote_plus
+_URL_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.~\-]')
 
-def GetAQAnnotations(df, props=[], lcProps=[], decodeProps=[], numPartitions=int(spark.conf.get('spark.sql.shuffle.partitions'))):
+def GetAQAnnotations(df, props=[], lcProps=[], decodeProps=[], numPartitions=None, preservePartitioning=False, partitionStrategy='hash', cache=False):
   """This function converts a Dataframe of CATAnnotations to a Dataframe of AQAnnotations.  
  
     A bare-bones AQAnnotation (with no properties) can be generated by only passing a Dataframe of CATAnnotations. 
@@ -29,48 +36,160 @@ def GetAQAnnotations(df, props=[], lcProps=[], decodeProps=[], numPartitions=int
     props: Array of property names  (from the name-value pairs in the other column in CATAnnotation) that you would like populated in the AQAnnotation Map of properties.
     lcProps: Array of property names where the value should be lower cased when populating the AQAnnotation Map of properties.
     decodeProps: Array of property names where the value should be url decoded when populating the AQAnnotation Map of properties.
-    numPartitions: Number of partitions for the Dataframe of AQAnnotations.
+    numPartitions: Number of partitions for the Dataframe of AQAnnotations.  Default is the current value of spark.sql.shuffle.partitions for the SparkSession of df.
+    preservePartitioning: Whether to keep the partitioning of the Dataframe of CATAnnotations instead of repartitioning by docId.  Only set to True if all annotations for a docId are already in the same partition.  Default is False.
+    partitionStrategy: How to repartition the AQAnnotations by docId.  Possible values are 'hash' and 'range'.  'range' balances the partitions using a sample of the docIds which reduces skew when document sizes vary.  'range' can not be used with preservePartitioning.  Default is 'hash'.
+    cache: Whether to persist (MEMORY_AND_DISK) and materialize the Dataframe of CATAnnotations before converting it.  Useful when GetAQAnnotations is called multiple times for the same Dataframe of CATAnnotations.  The caller should unpersist the Dataframe of CATAnnotations when done.  Default is False.
 
   Returns:
     Dataframe of AQAnnotations
 
   """
   
-  def GetAQProperties(set, other, props=[], lcProps=[], decodeProps=[]):
+  propsSet = frozenset(props)
+  lcPropsSet = frozenset(lcProps)
+  decodePropsSet = frozenset(decodeProps)
+  allProps = _WILDCARD in propsSet
+  allLcProps = _WILDCARD in lcPropsSet
+  allDecodeProps = _WILDCARD in decodePropsSet
+
+  def GetProperties(set, other):
+    propsMap = {}
+    for nameValuePair in _NAME_VALUE_PAIR.finditer(other):
+      otherTok, key, value = nameValuePair.groups()
+      if allProps or key in propsSet:
+        if allDecodeProps or key in decodePropsSet:
+          value =  unquote_plus(value)
+        if allLcProps or key in lcPropsSet:
+          value = value.lower()
+        propsMap[key] = value
+    return propsMap
+
+  def GetAttrProperties(set, other):
     propsMap = {}
     attrBuf = []
-    if len(props) > 0:
-      otherToks = other.split('&')
-      for otherTok in otherToks:
-        toks = otherTok.split('=')
-        if len(toks) == 2:
-          key = toks[0]
-          value = toks[1]
-          if any(p in props for p in [key,_WILDCARD]):
-            if any(p in decodeProps for p in [key,_WILDCARD]):
-              value =  unquote_plus(value)
-            if any(p in lcProps for p in [key,_WILDCARD]):
-              value = value.lower()
-            if _WILDCARD in props and set.lower() == _OM_ANNOT_SET and key not in _OM_NON_ATTRIBUTE_PROPERTIES:
-              attrBuf.append(otherTok)
-            else:
-              propsMap[key] = value
-          elif _ATTR in props and set.lower() == _OM_ANNOT_SET:
-            if key not in _OM_NON_ATTRIBUTE_PROPERTIES:
-              attrBuf.append(otherTok)
-      if len(attrBuf) > 0 and _ATTR not in propsMap:
-        propsMap[_ATTR] = '&'.join(map(str,attrBuf))
+    isOm = set.lower() == _OM_ANNOT_SET
+    for nameValuePair in _NAME_VALUE_PAIR.finditer(other):
+      otherTok, key, value = nameValuePair.groups()
+      if allProps or key in propsSet:
+        if allDecodeProps or key in decodePropsSet:
+          value =  unquote_plus(value)
+        if allLcProps or key in lcPropsSet:
+          value = value.lower()
+        if allProps and isOm and key not in _OM_NON_ATTRIBUTE_PROPERTIES_SET:
+          attrBuf.append(otherTok)
+        else:
+          propsMap[key] = value
+      elif isOm:
+        if key not in _OM_NON_ATTRIBUTE_PROPERTIES_SET:
+          attrBuf.append(otherTok)
+    if len(attrBuf) > 0 and _ATTR not in propsMap:
+      propsMap[_ATTR] = '&'.join(attrBuf)
     return propsMap
+
+  # Only the om annotations need the attr handling and that is only when the wildcard or attr is in props
+  if allProps or (_ATTR in propsSet):
+    GetAQProperties = GetAttrProperties
+  else:
+    GetAQProperties = GetProperties
         
-  GetAQPropertiesUDF = udf(GetAQProperties,MapType(StringType(),StringType()))
-
-  props_lit = array(*[lit(p) for p in props])
-  lc_props_lit = array(*[lit(p) for p in lcProps])
-  decode_props_lit = array(*[lit(p) for p in decodeProps])
-  aqdf = df.withColumn('properties', GetAQPropertiesUDF(col('annotSet'),col('other'),props_lit,lc_props_lit,decode_props_lit)) \
-           .drop('other','text') \
-           .repartition(numPartitions,'docId') \
-           .sortWithinPartitions('docId','startOffset','endOffset')
+  def SqlStrings(values):
+    return ','.join("'" + v.replace('\\','\\\\').replace("'","\\'") + "'" for v in values)
+
+  def SqlKeyIn(values):
+    if _WILDCARD in values:
+      return 'true'
+    elif len(values) == 0:
+      return 'false'
+    else:
+      return '(nv[0] IN (' + SqlStrings(values) + '))'
+
+  def GetAQPropertiesExpr():
+    if len(props) == 0:
+      return 'CAST(map() AS map<string,string>)'
+
+    # Name-value pairs from the other column (pairs not of the form name=value are ignored)
+    nvPairs = "filter(transform(split(other, '&'), tok -> split(tok, '=')), nv -> size(nv) = 2)"
+    keep = SqlKeyIn(props)
+    lc = SqlKeyIn(lcProps)
+    if lc == 'true':
+      value = 'lower(nv[1])'
+    elif lc == 'false':
+      value = 'nv[1]'
+    else:
+      value = 'CASE WHEN ' + lc + ' THEN lower(nv[1]) ELSE nv[1] END'
+
+    def Select(cond, item):
+      if cond == 'true':
+        return 'transform(pairs, nv -> ' + item + ')'
+      return 'transform(filter(pairs, nv -> ' + cond + '), nv -> ' + item + ')'
+
+    def Let(name, bound, body):
+      # Bind the expression to name so it is only evaluated once
+      return 'element_at(transform(array(' + bound + '), ' + name + ' -> ' + body + '), 1)'
+
+    def PropertiesExpr(propsCond, attrCond):
+      # The last value wins when a property name occurs more than once (same as the UDF)
+      propsMap = ('map_from_arrays(array_distinct(acc.keys), ' +
+                  'transform(array_distinct(acc.keys), k -> element_at(reverse(acc.vals), CAST(array_position(reverse(acc.keys), k) AS int))))')
+      fields = "'keys', " + Select(propsCond, 'nv[0]') + ", 'vals', " + Select(propsCond, value)
+      if attrCond == None:
+        body = propsMap
+      else:
+        fields += ", 'attr', " + Select(attrCond, "concat(nv[0], '=', nv[1])")
+        # With the wildcard, attr can never be one of the om property names
+        hasAttr = 'size(acc.attr) > 0'
+        if _WILDCARD not in props:
+          hasAttr += " AND NOT array_contains(acc.keys, '" + _ATTR + "')"
+        body = ('CASE WHEN ' + hasAttr +
+                ' THEN map_concat(' + propsMap + ", map('" + _ATTR + "', array_join(acc.attr, '&')))" +
+                ' ELSE ' + propsMap + ' END')
+      return Let('pairs', nvPairs, Let('acc', 'named_struct(' + fields + ')', body))
+
+    # For the om annotations, name-value pairs that are not properties are kept in the attr property
+    nonAttr = '(nv[0] IN (' + SqlStrings(_OM_NON_ATTRIBUTE_PROPERTIES) + '))'
+    if _WILDCARD in props:
+      omExpr = PropertiesExpr(nonAttr, 'NOT ' + nonAttr)
+      notOmExpr = PropertiesExpr('true', None)
+    elif _ATTR in props:
+      omExpr = PropertiesExpr(keep, 'NOT ' + keep + ' AND NOT ' + nonAttr)
+      notOmExpr = PropertiesExpr(keep, None)
+    else:
+      return PropertiesExpr(keep, None)
+
+    # The annotation set is only checked once per row
+    return "CASE WHEN lower(annotSet) = '" + _OM_ANNOT_SET + "' THEN " + omExpr + ' ELSE ' + notOmExpr + ' END'
+
+  if partitionStrategy not in ('hash', 'range'):
+    raise ValueError("partitionStrategy must be 'hash' or 'range', not " + repr(partitionStrategy))
+  if preservePartitioning and partitionStrategy == 'range':
+    raise ValueError("partitionStrategy 'range' can not be used with preservePartitioning")
+
+  if numPartitions is None:
+    numPartitions = int(df.sql_ctx.sparkSession.conf.get('spark.sql.shuffle.partitions'))
+
+  if cache:
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+    df.count()
+
+  # Drop the text before computing the properties so it is not carried through the UDF
+  catdf = df.drop('text')
+
+  # Url decoding is not available in Spark SQL so the Python UDF is only used when a property in props needs to be decoded
+  decodeAnyProps = (len(propsSet) > 0) and (len(decodePropsSet) > 0) and (allProps or allDecodeProps or not propsSet.isdisjoint(decodePropsSet))
+  if not decodeAnyProps:
+    aqdf = catdf.withColumn('properties', expr(GetAQPropertiesExpr()))
+  else:
+    GetAQPropertiesUDF = udf(GetAQProperties,MapType(StringType(),StringType()))
+    aqdf = catdf.withColumn('properties', GetAQPropertiesUDF(col('annotSet'),col('other')))
+
+  aqdf = aqdf.drop('other')
+  if not preservePartitioning:
+    if partitionStrategy == 'range':
+      aqdf = aqdf.repartitionByRange(numPartitions,'docId')
+    else:
+      aqdf = aqdf.repartition(numPartitions,'docId')
+  aqdf = aqdf.sortWithinPartitions('docId','startOffset','endOffset')
   return aqdf
 
 
@@ -90,29 +209,41 @@ def GetCATAnnotations(df, props=[], encodeProps=[]):
 
   """
 
-  def GetCATProperties(properties, props=[], encodeProps=[]):
+  propsSet = frozenset(props)
+  encodePropsSet = frozenset(encodeProps)
+  allProps = _WILDCARD in propsSet
+  allEncodeProps = _WILDCARD in encodePropsSet
+
+  def GetCATProperties(properties):
     otherBuf = []
     if (properties != None):
       for prop in properties:
-        if (_WILDCARD in props) or (prop in props):
-          if (_WILDCARD in encodeProps) or (prop in encodeProps):
+        if allProps or (prop in propsSet):
+          if (allEncodeProps or (prop in encodePropsSet)) and _URL_UNSAFE_CHARS.search(properties[prop]):
             otherBuf.append(prop + '=' + quote_plus(properties[prop]))
           else:
             otherBuf.append(prop + '=' + properties[prop])
-      return '&'.join(map(str,otherBuf))
+      return '&'.join(otherBuf)
     else:
       return None
 
-  GetCATPropertiesUDF = udf(GetCATProperties)
+  def GetUnencodedCATProperties(properties):
+    if (properties != None):
+      return '&'.join([prop + '=' + properties[prop] for prop in properties if allProps or (prop in propsSet)])
+    else:
+      return None
+
+  if len(encodePropsSet) == 0:
+    GetCATPropertiesUDF = udf(GetUnencodedCATProperties)
+  else:
+    GetCATPropertiesUDF = udf(GetCATProperties)
 
-  props_lit = array(*[lit(p) for p in props])
-  encode_props_lit = array(*[lit(p) for p in encodeProps])
-  catdf = df.withColumn("other", GetCATPropertiesUDF(col("properties"),props_lit,encode_props_lit)) \
+  catdf = df.withColumn("other", GetCATPropertiesUDF(col("properties"))) \
             .drop("properties") 
   return catdf
 
 
-def Hydrate(df, txtPath, excludes=True):
+def Hydrate(df, txtPath, excludes=True, broadcastThreshold=0):
   """This function will retrieve the text for each AQAnnotation in the passed Dataframe of AQAnnotations, populate the text property with this value in the AQAnnotation, and return a Dataframe of AQAnnotations with the text property populated.  
  
     Keep in mind that for 'text/word' annotations the orig column will already be populated with the 'original' text value so this may not be needed.  
@@ -122,55 +253,65 @@ def Hydrate(df, txtPath, excludes=True):
     df: The Dataframe of Annotations that we want to populate the text property with the text for this annotation
     textPath: Path the str files.  The str files for the documents in the ds annotations must be found here.
     excludes: Whether we want to include the 'excludes' text.  True means exclude the excluded text.
+    broadcastThreshold: Maximum size (in bytes) of the str files for the documents in df that will be read on the driver and broadcast to the executors.  The str files must be accessible from the driver.  Checking the size runs an extra (eager) job to collect the distinct docIds in df, which evaluates the whole plan for df.  The broadcast text is not released when the returned Dataframe is no longer used.  Default is 0 (never broadcast).
 
   Returns:
     Dataframe of AQAnnotations
   """
 
-  def HydrateText(docId, startOffset, endOffset, properties, txtPath, excludes):
-  
-    # Read in the text for the document (want to think about ways for improving performance)
-    docText = ''
-    text = ''
+  def ReadDocText(docId):
+    try:
+      with open(txtPath + docId,'rb') as f:
+        docText = f.read().decode('utf-8')
+      # Same newline translation as reading in text mode
+      if '\r' in docText:
+        docText = docText.replace('\r\n','\n').replace('\r','\n')
+      return docText
+    except Exception as ex:
+      print(ex)
+      return ""
+
+  # Broadcast the text for the documents if it is small enough
+  corpus = None
+  if broadcastThreshold > 0:
+    docIds = [row.docId for row in df.select('docId').distinct().collect()]
+    docPaths = [txtPath + docId for docId in docIds]
+    if all(os.path.isfile(docPath) for docPath in docPaths) and (builtins.sum(os.path.getsize(docPath) for docPath in docPaths) <= broadcastThreshold):
+      corpus = df.sql_ctx.sparkSession.sparkContext.broadcast({docId: ReadDocText(docId) for docId in docIds})
+
+  # Text for the current document.  The UDF is deserialized for each task so this is local to the partition.
+  docCache = {}
+
+  def HydrateText(docId, startOffset, endOffset, properties):
   
-    # Check if file already has been read (written to tmp space)
-    if os.path.exists('/tmp/' + docId):
-      with io.open('/tmp/' + docId,'r',encoding='utf-8') as f:
-        docText = f.read()
+    # Use the broadcast text if available.  Otherwise, annotations are sorted by docId within the partition so only the current document needs to be kept
+    if corpus != None:
+      docText = corpus.value.get(docId, "")
+    elif docId in docCache:
+      docText = docCache[docId]
     else:
-      try:
-        with io.open(txtPath + docId,'r',encoding='utf-8') as f:
-          docText = f.read()
-        with io.open('/tmp/' + docId,'w',encoding='utf-8') as f:
-          f.write(docText)
-      except Exception as ex:
-        print(ex)
-        docText=""
+      docText = ReadDocText(docId)
+      docCache.clear()
+      docCache[docId] = docText
     
     # Return properties if docText was empty or 'text' is already defined in the properties
     if (docText == '') or ((properties != None) and ('text' in properties)):
       return properties
     else:
       if (excludes) and (properties != None) and ('excludes' in properties) and (len(properties['excludes']) > 0):
-        excludes = []
-        exToks = []
-        for excludesEntry in properties['excludes'].split("|"):
-          toks = excludesEntry.split(",")  
-          excludes.append((int(toks[0]),toks[1],toks[2],int(toks[3]),int(toks[4])))
-        excludes = list(set(excludes))
-        for exclude in excludes:
-          exToks.append((exclude[3],exclude[4]))
-        exToks = list(set(exToks))
-        exToks.sort(key=lambda tup: (tup[0], tup[1]))
+        # Unique (startOffset,endOffset) of the excluded annotations in offset order
+        exToks = sorted({(int(toks[3]),int(toks[4])) for toks in (excludesEntry.split(",") for excludesEntry in properties['excludes'].split("|"))})
+        parts = []
         curOffset = startOffset
         for exTok in exToks:
           if exTok[0] <= curOffset:
             curOffset = exTok[1]
           else:
-            text = text + docText[curOffset:exTok[0]]
+            parts.append(docText[curOffset:exTok[0]])
             curOffset = exTok[1]
         if curOffset < endOffset:
-          text = text + docText[curOffset:endOffset]
+          parts.append(docText[curOffset:endOffset])
+        text = ''.join(parts)
         
       else:
         text = docText[startOffset:endOffset]
@@ -185,5 +326,5 @@ def Hydrate(df, txtPath, excludes=True):
   HydrateTextUDF = udf(HydrateText,MapType(StringType(),StringType()))
 
   hydratedf = df.sortWithinPartitions('docId') \
-                .withColumn('properties', HydrateTextUDF(col('docId'),col('startOffset'),col('endOffset'),col('properties'),lit(txtPath),lit(excludes)))
+                .withColumn('properties', HydrateTextUDF(col('docId'),col('startOffset'),col('endOffset'),col('properties')))
   return hydratedf
\ No newline at end of file
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
+import shutil
+import tempfile
 from AQPython.Utilities import *
 from AQPython.Query import *
 import pyspark 
@@ -15,9 +17,6 @@ class UtilitiesTestSuite(unittest.TestCase):
 
         spark.conf.set("spark.sql.shuffle.partitions",4)
 
-        if os.path.exists("/tmp/S0022314X13001777"):
-            os.remove("/tmp/S0022314X13001777")
-
     # Test GetAQAnnotations count 
     def test_Utilities1(self):
         annots = GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"),
@@ -149,3 +148,123 @@ class UtilitiesTestSuite(unittest.TestCase):
         sentenceAnnots = FilterType(annots, "sentence") 
         hydratedAnnots = Hydrate(sentenceAnnots,"./tests/resources/str/",False)
         self.assertEquals(Row(docId='S0022314X13001777', annotSet='ge', annotType='sentence', startOffset=20490, endOffset=20777, annotId=256, properties={'excludes': '2872,om,mml:math,20501,20510|2894,om,mml:math,20540,20546|2907,om,mml:math,20586,20590|2913,om,mml:math,20627,20630|2923,om,mml:math,20645,20651|2933,om,mml:math,20718,20721', 'text': 'A function g:Zpn→Zpn arising from a polynomial in Zpn[x] or, equivalently, from a polynomial in Z[x], is called a polynomial function on Zpn. We denote by (Fn,∘) the monoid with respect to composition of polynomial functions on Zpn. By monoid, we mean semigroup with an identity element.'}),hydratedAnnots.select("annotId","annotSet","annotType","docId","endOffset","properties","startOffset").collect()[8])
+
+    # Test Hydrate sentence with excludes using broadcast text
+    def test_Utilities14(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"),
+                                      ["orig", "lemma", "pos", "excludes"],
+                                      ["lemma", "pos"],
+                                      ["orig", "lemma"]) 
+
+        txtPath = tempfile.mkdtemp() + "/"
+        shutil.copy("./tests/resources/str/S0022314X13001777", txtPath)
+        sentenceAnnots = FilterType(annots, "sentence").filter(col("annotId") == 256)
+        broadcastAnnots = Hydrate(sentenceAnnots,txtPath,broadcastThreshold=10000000)
+        notBroadcastAnnots = Hydrate(sentenceAnnots,txtPath,broadcastThreshold=1000)
+
+        # Once the str file is removed only the broadcast text is available
+        shutil.rmtree(txtPath)
+        excludes = '2872,om,mml:math,20501,20510|2894,om,mml:math,20540,20546|2907,om,mml:math,20586,20590|2913,om,mml:math,20627,20630|2923,om,mml:math,20645,20651|2933,om,mml:math,20718,20721'
+        self.assertEqual({'excludes': excludes, 'text': 'A function  arising from a polynomial in  or, equivalently, from a polynomial in , is called a polynomial function on . We denote by  the monoid with respect to composition of polynomial functions on . By monoid, we mean semigroup with an identity element.'}, broadcastAnnots.collect()[0].properties)
+        self.assertEqual({'excludes': excludes}, notBroadcastAnnots.collect()[0].properties)
+
+    # Test GetAQAnnotations om property wildcard (without url decode)
+    def test_Utilities15(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/om/"),
+                                      ["*"])
+
+        self.assertEqual({'origAnnotID': '7', 'attr': 'type=alllist', 'orig': '291210', 'parentId': '6'}, annots.filter(col("annotId") == 7).collect()[0].properties)
+        self.assertEqual({'origAnnotID': '4', 'orig': 'JL', 'parentId': '2'}, annots.filter(col("annotId") == 4).collect()[0].properties)
+
+    # Test GetAQAnnotations om attr property (without url decode)
+    def test_Utilities16(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/om/"),
+                                      ["attr", "orig"])
+
+        self.assertEqual({'attr': 'type=alllist', 'orig': '291210'}, annots.filter(col("annotId") == 7).collect()[0].properties)
+        self.assertEqual({'orig': 'JL'}, annots.filter(col("annotId") == 4).collect()[0].properties)
+
+    # Test GetAQAnnotations om lower case property (without url decode)
+    def test_Utilities17(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/om/"),
+                                      ["orig"],
+                                      ["orig"])
+
+        self.assertEqual({'orig': 'jl'}, annots.filter(col("annotId") == 4).collect()[0].properties)
+        self.assertEqual({}, annots.filter(col("annotId") == 1).collect()[0].properties)
+
+    # Test GetAQAnnotations duplicate property names (last value wins)
+    def test_Utilities18(self):
+        catAnnots = spark.createDataFrame([Row(docId='S0022314X13001777', annotSet='ge', annotType='word', startOffset=0, endOffset=5, annotId=1, other='orig=A&pos=x&orig=B'),
+                                           Row(docId='S0022314X13001777', annotSet='om', annotType='p', startOffset=0, endOffset=5, annotId=2, other='orig=A&type=t&orig=B&parentId=1')])
+        for decodeProps in [[], ["pos"]]:
+            annots = GetAQAnnotations(catAnnots, ["*"], [], decodeProps)
+            self.assertEqual({'orig': 'B', 'pos': 'x'}, annots.filter(col("annotId") == 1).collect()[0].properties)
+            self.assertEqual({'orig': 'B', 'attr': 'type=t', 'parentId': '1'}, annots.filter(col("annotId") == 2).collect()[0].properties)
+
+    # Test GetAQAnnotations preserving the partitioning by docId
+    def test_Utilities19(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/genia/").repartition(3, "docId"),
+                                      ["orig", "lemma", "pos", "excludes"],
+                                      ["lemma", "pos"],
+                                      ["orig", "lemma"],
+                                      preservePartitioning=True)
+
+        self.assertEqual(3, annots.rdd.getNumPartitions())
+        self.assertEqual(4066, annots.count())
+        self.assertEqual(dict(docId='S0022314X13001777', annotSet='ge', annotType='word', startOffset=18546, endOffset=18551, annotId=3, properties={'lemma': 'sylow', 'pos': 'jj', 'orig': 'Sylow'}), annots.orderBy(["docId", "startOffset","endOffset","annotType"]).collect()[0].asDict())
+
+    # Test GetAQAnnotations range partitioning
+    def test_Utilities20(self):
+        annots = GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"),
+                                      ["orig", "lemma", "pos", "excludes"],
+                                      ["lemma", "pos"],
+                                      ["orig", "lemma"],
+                                      partitionStrategy='range')
+
+        self.assertIn('rangepartitioning(docId', annots._jdf.queryExecution().executedPlan().toString())
+        self.assertEqual(4066, annots.count())
+        self.assertEqual(dict(docId='S0022314X13001777', annotSet='ge', annotType='word', startOffset=18546, endOffset=18551, annotId=3, properties={'lemma': 'sylow', 'pos': 'jj', 'orig': 'Sylow'}), annots.orderBy(["docId", "startOffset","endOffset","annotType"]).collect()[0].asDict())
+
+    # Test GetAQAnnotations invalid partitioning
+    def test_Utilities21(self):
+        with self.assertRaises(ValueError):
+            GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"), ["orig"], partitionStrategy='Range')
+        with self.assertRaises(ValueError):
+            GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"), ["orig"], preservePartitioning=True, partitionStrategy='range')
+
+    # Test GetAQAnnotations caching the CATAnnotations
+    def test_Utilities22(self):
+        catAnnots = spark.read.parquet("./tests/resources/genia/")
+        annots = GetAQAnnotations(catAnnots,
+                                      ["orig", "lemma", "pos", "excludes"],
+                                      ["lemma", "pos"],
+                                      ["orig", "lemma"],
+                                      cache=True)
+
+        self.assertTrue(catAnnots.is_cached)
+        self.assertEqual(4066, annots.count())
+        catAnnots.unpersist()
+
+    # Test GetAQAnnotations default number of partitions after changing spark.sql.shuffle.partitions
+    def test_Utilities23(self):
+        spark.conf.set("spark.sql.shuffle.partitions",5)
+        try:
+            annots = GetAQAnnotations(spark.read.parquet("./tests/resources/genia/"),
+                                          ["orig", "lemma", "pos", "excludes"],
+                                          ["lemma", "pos"],
+                                          ["orig", "lemma"])
+
+            self.assertEqual(5, annots.rdd.getNumPartitions())
+        finally:
+            spark.conf.set("spark.sql.shuffle.partitions",4)
+
+    # Test GetCATAnnotations url encoding values that are not url safe
+    def test_Utilities24(self):
+        annots = spark.createDataFrame([Row(docId='S0022314X13001777', annotSet='ge', annotType='word', startOffset=0, endOffset=5, annotId=1, properties={'orig': 'a b&c=d é'}),
+                                        Row(docId='S0022314X13001777', annotSet='ge', annotType='word', startOffset=6, endOffset=11, annotId=2, properties={'orig': 'Sylow-2.x_y~z'})])
+
+        catAnnots = GetCATAnnotations(annots,["orig"],["orig"])
+        self.assertEqual('orig=' + quote_plus('a b&c=d é'), catAnnots.filter(col("annotId") == 1).collect()[0].other)
+        self.assertEqual('orig=a+b%26c%3Dd+%C3%A9', catAnnots.filter(col("annotId") == 1).collect()[0].other)
+        self.assertEqual('orig=Sylow-2.x_y~z', catAnnots.filter(col("annotId") == 2).collect()[0].other)